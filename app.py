@@ -1,8 +1,8 @@
 import streamlit as st
+import hashlib
+import io
 import os
-from pathlib import Path
 from PIL import Image
-import tempfile
 from clip_vector_db import CLIPVectorDB
 from path_utils import normalize_path, validate_path_exists, convert_wsl_path_to_windows
 import pillow_heif
@@ -20,6 +20,57 @@ st.set_page_config(
 def load_db():
     return CLIPVectorDB()
 
+@st.cache_data(ttl="30s")
+def _db_size_mb(root: str) -> float:
+    total = 0
+    stack = [root]
+    while stack:
+        # 取り込み中は SQLite のジャーナルなどが一覧取得と stat の間に消えることがあるので飛ばす
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            total += entry.stat(follow_symlinks=False).st_size
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return total / (1024 * 1024)
+
+@st.cache_data(max_entries=1024, ttl="30m")
+def _thumb(path: str, mtime: float, max_px: int = 400) -> bytes:
+    # mtime をキーに含めて、画像が更新されたらキャッシュを作り直す
+    image = Image.open(path)
+    if image.format == 'JPEG':
+        # libjpeg の縮小デコードで必要な解像度だけを展開する
+        image.draft('RGB', (max_px * 2, max_px * 2))
+    image = image.convert('RGB')
+    image.thumbnail((max_px, max_px), Image.Resampling.LANCZOS)
+    buf = io.BytesIO()
+    image.save(buf, format="WEBP")
+    return buf.getvalue()
+
+@st.cache_data(max_entries=256)
+def _query_vec(qhash: str, _image: Image.Image) -> list:
+    # 画像の内容ハッシュをキーにし、画像オブジェクト自体はハッシュしない
+    vector = load_db().encode_image(_image)
+    if vector is None:
+        # 失敗をキャッシュしないよう例外で抜け、同じ画像の再アップロードで再計算させる
+        raise ValueError(f"Failed to encode query image {qhash}")
+    return vector.tolist()
+
+@st.cache_data(max_entries=512, ttl="1h")
+def _text_vec(text: str) -> list:
+    # スライダー操作などの再実行でテキストエンコーダを回さないようにキャッシュする
+    vector = load_db().encode_text(text)
+    if vector is None:
+        # 失敗をキャッシュしないよう例外で抜け、次の再実行で再計算させる
+        raise ValueError(f"Failed to encode text '{text}'")
+    return vector.tolist()
+
 def main():
     st.title("🔍 画像類似検索アプリ")
     st.markdown("CLIP ベクトルを使用した画像の類似検索システム")
@@ -42,42 +93,46 @@ def main():
             top_k = st.slider("表示する類似画像数", min_value=1, max_value=500, value=10)
         
         if uploaded_file is not None:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                query_image_path = tmp_file.name
+            image_bytes = uploaded_file.getvalue()
+            image = Image.open(io.BytesIO(image_bytes))
+            image.load()
             
             col1, col2 = st.columns([1, 2])
             
             with col1:
                 st.subheader("検索画像")
-                image = Image.open(query_image_path)
                 st.image(image, caption="アップロードされた画像", use_container_width=True)
             
             with col2:
                 st.subheader("類似画像検索中...")
                 with st.spinner("CLIP ベクトルを計算しています..."):
-                    similar_images = db.search_similar(query_image_path, top_k)
+                    qhash = hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+                    try:
+                        similar_images = db.search_by_vector(_query_vec(qhash, image), top_k)
+                    except ValueError:
+                        similar_images = []
                 
                 if similar_images:
                     st.success(f"{len(similar_images)}件の類似画像が見つかりました")
                     
+                    # 画像はまとめて 1 回の st.image で送る
+                    thumbs, captions, file_lines = [], [], []
                     for i, (image_path, similarity) in enumerate(similar_images):
                         if os.path.exists(image_path):
                             try:
-                                st.markdown(f"**{i+1}. 類似度: {similarity:.4f}**")
-                                st.markdown(f"ファイル: `{convert_wsl_path_to_windows(image_path)}`")
-                                
-                                similar_image = Image.open(image_path)
-                                st.image(similar_image, caption=f"類似度: {similarity:.4f}", width=300)
-                                st.markdown("---")
+                                thumbs.append(_thumb(image_path, os.path.getmtime(image_path)))
+                                captions.append(f"{i+1}. 類似度: {similarity:.4f}")
+                                file_lines.append(f"- **{i+1}.** 類似度: {similarity:.4f} `{convert_wsl_path_to_windows(image_path)}`")
                             except Exception as e:
                                 st.error(f"画像を読み込めませんでした: {image_path}")
                         else:
                             st.warning(f"ファイルが見つかりません: {image_path}")
+                    
+                    if thumbs:
+                        st.image(thumbs, caption=captions, width=300)
+                        st.markdown("\n".join(file_lines))
                 else:
                     st.warning("類似画像が見つかりませんでした。データベースを更新してください。")
-            
-            os.unlink(query_image_path)
     
     with tabs[1]:
         st.header("文字列で画像検索")
@@ -97,28 +152,41 @@ def main():
             st.subheader(f"「{query_text}」の検索結果")
             
             with st.spinner("テキストをベクトル化して画像を検索しています..."):
-                similar_images = db.search_by_text(query_text, top_k)
+                try:
+                    similar_images = db.search_by_vector(_text_vec(query_text), top_k)
+                except ValueError:
+                    similar_images = []
             
             if similar_images:
                 st.success(f"{len(similar_images)}件の関連画像が見つかりました")
                 
-                # グリッド表示で画像を配置
+                # グリッド表示で画像を配置（列ごとに 1 回の st.image で送る）
                 cols = st.columns(3)
+                col_thumbs = [[] for _ in cols]
+                col_captions = [[] for _ in cols]
+                file_lines = []
                 for i, (image_path, similarity) in enumerate(similar_images):
                     col_idx = i % 3
                     
-                    with cols[col_idx]:
-                        if os.path.exists(image_path):
-                            try:
-                                image = Image.open(image_path)
-                                st.image(image, caption=f"類似度: {similarity:.4f}", use_container_width=True)
-                                st.markdown(f"**ファイル:** `{os.path.basename(image_path)}`")
-                                st.markdown(f"**パス:** `{convert_wsl_path_to_windows(image_path)}`")
-                                st.markdown("---")
-                            except Exception as e:
+                    if os.path.exists(image_path):
+                        try:
+                            col_thumbs[col_idx].append(_thumb(image_path, os.path.getmtime(image_path)))
+                            col_captions[col_idx].append(f"{i+1}. 類似度: {similarity:.4f} {os.path.basename(image_path)}")
+                            file_lines.append(f"- **{i+1}.** `{convert_wsl_path_to_windows(image_path)}`")
+                        except Exception as e:
+                            with cols[col_idx]:
                                 st.error(f"画像を読み込めませんでした: {os.path.basename(image_path)}")
-                        else:
+                    else:
+                        with cols[col_idx]:
                             st.warning(f"ファイルが見つかりません: {os.path.basename(image_path)}")
+                
+                for col, thumbs, captions in zip(cols, col_thumbs, col_captions):
+                    if thumbs:
+                        with col:
+                            st.image(thumbs, caption=captions, use_container_width=True)
+                
+                if file_lines:
+                    st.markdown("**パス:**\n\n" + "\n".join(file_lines))
             else:
                 st.warning("関連画像が見つかりませんでした。データベースを更新するか、別のキーワードを試してください。")
                 st.info("💡 検索のコツ:\n- 簡潔な単語を使用（「猫」「車」「花」など）\n- 英語でも検索可能（「cat」「car」「flower」など）\n- 色や形容詞も有効（「赤い花」「大きな犬」など）")
@@ -171,6 +239,13 @@ def main():
         with col2:
             st.subheader("操作")
             
+            if st.button("インデックスを再構築", help="登録済みの画像はそのままに、現在の HNSW 設定でインデックスを作り直します"):
+                with st.spinner("インデックスを再構築しています..."):
+                    if db.rebuild_index():
+                        st.success("インデックスを再構築しました")
+                    else:
+                        st.error("インデックスの再構築に失敗しました")
+            
             if st.button("データベースをクリア", type="secondary"):
                 if st.checkbox("本当にデータベースをクリアしますか？"):
                     db.clear_database()
@@ -189,7 +264,7 @@ def main():
         
         with col2:
             if os.path.exists(db.db_path):
-                db_size = sum(f.stat().st_size for f in Path(db.db_path).rglob('*') if f.is_file()) / (1024 * 1024)
+                db_size = _db_size_mb(db.db_path)
                 st.metric("DB サイズ", f"{db_size:.2f} MB")
         
         with col3:
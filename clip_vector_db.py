@@ -1,6 +1,9 @@
+import itertools
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Union
 import numpy as np
 from PIL import Image
 import torch
@@ -8,16 +11,202 @@ import clip
 from tqdm import tqdm
 import chromadb
 from chromadb.config import Settings
+from torch.utils.data import DataLoader, Dataset
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+try:
+    from torchvision.io import ImageReadMode, decode_jpeg, read_file
+    from torchvision.transforms import v2
+except ImportError:
+    decode_jpeg = None
+
+ENCODE_BATCH_SIZE = 64
+# SQLite のパラメータ数上限に収まるよう ID をまとめて問い合わせる単位
+GET_BATCH_SIZE = 10000
+# 1 トランザクションでまとめて書き込む件数
+UPSERT_BATCH_SIZE = 512
+# stat は I/O 待ちで GIL を解放するので、ネットワークドライブではスレッド数に応じて速くなる
+STAT_WORKERS = 32
+# HNSW のパラメータ。M / search_ef を大きくするほど再現率が上がり、検索とインデックス構築は遅くなる
+HNSW_M = int(os.environ.get("CLIP_HNSW_M", 24))
+HNSW_CONSTRUCTION_EF = 200
+HNSW_SEARCH_EF = int(os.environ.get("CLIP_HNSW_EF_SEARCH", 100))
+COLLECTION_NAME = "image_vectors"
+REBUILD_COLLECTION_NAME = "image_vectors_rebuild"
+IMAGE_EXTENSIONS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.heic'})
+JPEG_EXTENSIONS = frozenset({'.jpg', '.jpeg'})
+# clip.load の preprocess と同じ正規化パラメータ
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
+
+
+def _stat_or_none(path: str):
+    try:
+        return os.stat(path)
+    except OSError as e:
+        print(f"Error adding image {path}: {e}")
+        return None
+
+
+def _iter_image_files(root: str, extensions=IMAGE_EXTENSIONS):
+    # os.walk と違い DirEntry の種別情報を使うので余分な stat が発生しない
+    try:
+        with os.scandir(root) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from _iter_image_files(entry.path, extensions)
+                elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in extensions:
+                    yield entry.path
+    except OSError as e:
+        print(f"Error scanning folder {root}: {e}")
+
+
+class _ImageDataset(Dataset):
+    def __init__(self, image_paths: List[str], preprocess):
+        self.image_paths = image_paths
+        self.preprocess = preprocess
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        path = self.image_paths[idx]
+        try:
+            return path, self.preprocess(Image.open(path).convert('RGB'))
+        except Exception as e:
+            print(f"Error encoding image {path}: {e}")
+            return path, None
+
+
+def _collate_images(batch):
+    # 読み込みに失敗した画像はバッチから除外するが、進捗のために試行した件数は返す
+    attempted = len(batch)
+    batch = [(path, image) for path, image in batch if image is not None]
+    if not batch:
+        return [], None, attempted
+    paths, images = zip(*batch)
+    return list(paths), torch.stack(images), attempted
+
+
+class _JpegBytesDataset(Dataset):
+    def __init__(self, image_paths: List[str]):
+        self.image_paths = image_paths
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        path = self.image_paths[idx]
+        try:
+            return path, read_file(path)
+        except Exception as e:
+            print(f"Error encoding image {path}: {e}")
+            return path, None
+
+
+def _collate_jpeg_bytes(batch):
+    attempted = len(batch)
+    batch = [(path, data) for path, data in batch if data is not None]
+    return [path for path, _ in batch], [data for _, data in batch], attempted
+
 
 class CLIPVectorDB:
-    def __init__(self, db_path: str = "./chroma_db", model_name: str = "ViT-B/32"):
+    def __init__(self, db_path: str = "./chroma_db", model_name: str = "ViT-B/32", onnx_dir: str = "./onnx"):
         self.db_path = db_path
         self.model_name = model_name
+        self.onnx_dir = onnx_dir
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         
         self.model, self.preprocess = clip.load(model_name, device=self.device)
+        if self.device.type == "cuda":
+            # CLIP は推論時 FP16 で精度が落ちないため GPU では半精度で動かす
+            self.model = self.model.half()
+        self.model.eval()
+        n_px = self.model.visual.input_resolution
+        
+        # CUDA 環境では JPEG を nvJPEG でデコードし、リサイズと正規化も GPU 上で行う
+        self.gpu_preprocess = None
+        if self.device.type == "cuda" and decode_jpeg is not None:
+            self.gpu_preprocess = v2.Compose([
+                v2.Resize(n_px, interpolation=v2.InterpolationMode.BICUBIC, antialias=True),
+                v2.CenterCrop(n_px),
+                v2.ToDtype(torch.float32, scale=True),
+                v2.Normalize(mean=CLIP_MEAN, std=CLIP_STD)
+            ])
+        
+        # scripts/export_clip.py で書き出した ONNX があれば onnxruntime で推論する
+        self.image_session = self._load_onnx_session("clip_image.onnx", "image", (3, n_px, n_px))
+        self.text_session = self._load_onnx_session("clip_text.onnx", "text", (self.model.context_length,))
         
         self.init_database()
+        
+        # 1 件のテキスト検索用に、固定長トークン列の転送バッファを使い回す
+        # インスタンスは Streamlit の全セッションで共有されるため、バッファの利用はロックで排他する
+        self._text_host = None
+        self._text_in = None
+        self._text_lock = threading.Lock()
+        if self.device.type == "cuda":
+            tokens = clip.tokenize([""])
+            self._text_host = torch.zeros_like(tokens).pin_memory()
+            self._text_in = torch.zeros_like(tokens, device=self.device)
+            
+            # 入力形状は固定なので cuDNN に最速のアルゴリズムを選ばせる
+            torch.backends.cudnn.benchmark = True
+            self._warmup()
+    
+    def _warmup(self):
+        # 初回推論時のカーネル選択や TensorRT エンジン構築を起動時に済ませておく
+        n_px = self.model.visual.input_resolution
+        self._encode_image_batch(torch.zeros(1, 3, n_px, n_px, device=self.device))
+        self._encode_text_tokens(clip.tokenize(["warmup"]))
+    
+    def _load_onnx_session(self, file_name: str, input_name: str, input_shape: Tuple[int, ...]):
+        onnx_path = os.path.join(self.onnx_dir, file_name)
+        if ort is None or not os.path.exists(onnx_path):
+            return None
+        
+        available = ort.get_available_providers()
+        gpu_available = "TensorrtExecutionProvider" in available or "CUDAExecutionProvider" in available
+        if self.device.type == "cuda" and not gpu_available:
+            # CPU 版 onnxruntime (chromadb の依存) しかない場合は GPU 上の PyTorch の方が速い
+            print(f"Skipping ONNX model {onnx_path}: onnxruntime-gpu is not installed")
+            return None
+        
+        providers = []
+        if "TensorrtExecutionProvider" in available:
+            # バッチサイズ 1〜ENCODE_BATCH_SIZE を 1 つのエンジンで扱い、端数のバッチで再構築させない
+            shape = "x".join(str(dim) for dim in input_shape)
+            providers.append(("TensorrtExecutionProvider", {
+                "trt_fp16_enable": True,
+                "trt_engine_cache_enable": True,
+                "trt_engine_cache_path": self.onnx_dir,
+                "trt_profile_min_shapes": f"{input_name}:1x{shape}",
+                "trt_profile_opt_shapes": f"{input_name}:{ENCODE_BATCH_SIZE}x{shape}",
+                "trt_profile_max_shapes": f"{input_name}:{ENCODE_BATCH_SIZE}x{shape}"
+            }))
+        if "CUDAExecutionProvider" in available:
+            providers.append("CUDAExecutionProvider")
+        providers.append("CPUExecutionProvider")
+        
+        try:
+            return ort.InferenceSession(onnx_path, providers=providers)
+        except Exception as e:
+            print(f"Error loading ONNX model {onnx_path}: {e}")
+            return None
+    
+    def _collection_metadata(self) -> dict:
+        return {
+            "description": "CLIP image embeddings",
+            "hnsw:space": "cosine",
+            "hnsw:M": HNSW_M,
+            "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+            "hnsw:search_ef": HNSW_SEARCH_EF,
+            "hnsw:num_threads": os.cpu_count() or 1
+        }
     
     def init_database(self):
         settings = Settings(
@@ -25,71 +214,180 @@ class CLIPVectorDB:
             allow_reset=True
         )
         self.client = chromadb.PersistentClient(path=self.db_path, settings=settings)
+        self._recover_rebuild()
         self.collection = self.client.get_or_create_collection(
-            name="image_vectors",
-            metadata={
-                "description": "CLIP image embeddings",
-                "hnsw:space": "cosine"
-            }
+            name=COLLECTION_NAME,
+            metadata=self._collection_metadata()
         )
     
-    def encode_image(self, image_path: str) -> np.ndarray:
+    def _recover_rebuild(self):
+        # 再構築で古いコレクションを削除した直後に中断した場合は、入れ直し済みのコレクションを使う
         try:
-            image = Image.open(image_path).convert('RGB')
-            image_input = self.preprocess(image).unsqueeze(0).to(self.device)
-            
+            self.client.get_collection(COLLECTION_NAME)
+            return
+        except Exception:
+            pass
+        try:
+            self.client.get_collection(REBUILD_COLLECTION_NAME).modify(name=COLLECTION_NAME)
+            print("Recovered image vectors from an interrupted index rebuild")
+        except Exception:
+            pass
+    
+    def _encode_image_batch(self, image_input: torch.Tensor) -> torch.Tensor:
+        if self.image_session is not None:
+            outputs = self.image_session.run(None, {"image": image_input.float().cpu().numpy()})
+            image_features = torch.from_numpy(outputs[0]).float()
+        else:
+            image_input = image_input.to(self.device, dtype=self.model.dtype, non_blocking=True)
             with torch.no_grad():
-                image_features = self.model.encode_image(image_input)
-                image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+                image_features = self.model.encode_image(image_input).float()
+        # 正規化は数値安定性のため FP32 で行う
+        return image_features / image_features.norm(dim=-1, keepdim=True)
+    
+    def _prefetch_to_device(self, loader):
+        # 次のバッチの転送を別ストリームで先に発行し、現在のバッチの推論と重ねる
+        if self.device.type != "cuda" or self.image_session is not None:
+            yield from loader
+            return
+        
+        copy_stream = torch.cuda.Stream()
+        
+        def to_device(batch):
+            if batch is None or batch[1] is None:
+                return batch
+            paths, images, attempted = batch
+            with torch.cuda.stream(copy_stream):
+                return paths, images.to(self.device, non_blocking=True), attempted
+        
+        batches = iter(loader)
+        next_batch = to_device(next(batches, None))
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(copy_stream)
+            paths, images, attempted = next_batch
+            if images is not None:
+                images.record_stream(torch.cuda.current_stream())
+            next_batch = to_device(next(batches, None))
+            yield paths, images, attempted
+    
+    def _iter_gpu_jpeg_batches(self, image_paths: List[str], fallback_paths: List[str], num_workers: int):
+        # ワーカーは圧縮されたままのバイト列を読むだけで、デコード以降は GPU で行う
+        loader = DataLoader(
+            _JpegBytesDataset(image_paths),
+            batch_size=ENCODE_BATCH_SIZE,
+            num_workers=num_workers,
+            collate_fn=_collate_jpeg_bytes
+        )
+        for paths, data, attempted in loader:
+            decoded_paths, images = [], []
+            # 高解像度の画像をバッチ全体分 GPU に展開しないよう、1 枚ずつデコードしてすぐ縮小する
+            for path, jpeg_bytes in zip(paths, data):
+                try:
+                    image = decode_jpeg(jpeg_bytes, mode=ImageReadMode.RGB, device=self.device)
+                except torch.cuda.OutOfMemoryError:
+                    raise
+                except RuntimeError as e:
+                    # CMYK などの nvJPEG で扱えない JPEG は CPU の経路に回す
+                    print(f"Falling back to CPU decoding for {path}: {e}")
+                    fallback_paths.append(path)
+                    # CPU の経路で改めて数えるのでここでは処理済みにしない
+                    attempted -= 1
+                    continue
+                decoded_paths.append(path)
+                images.append(self.gpu_preprocess(image))
+                del image
+            yield decoded_paths, torch.stack(images) if images else None, attempted
+    
+    def _iter_image_batches(self, image_paths: List[str]):
+        num_workers = (os.cpu_count() or 1) // 2
+        
+        cpu_paths = image_paths
+        if self.gpu_preprocess is not None:
+            is_jpeg = [os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS for path in image_paths]
+            cpu_paths = [path for path, jpeg in zip(image_paths, is_jpeg) if not jpeg]
+            jpeg_paths = [path for path, jpeg in zip(image_paths, is_jpeg) if jpeg]
+            # GPU でデコードできなかった JPEG は cpu_paths に追加され、続く CPU の経路で処理される
+            yield from self._iter_gpu_jpeg_batches(jpeg_paths, cpu_paths, num_workers)
+        
+        loader = DataLoader(
+            _ImageDataset(cpu_paths, self.preprocess),
+            batch_size=ENCODE_BATCH_SIZE,
+            num_workers=num_workers,
+            pin_memory=self.device.type == "cuda",
+            collate_fn=_collate_images
+        )
+        yield from self._prefetch_to_device(loader)
+    
+    def _encode_text_tokens(self, text_tokens: torch.Tensor) -> torch.Tensor:
+        if self.text_session is not None:
+            outputs = self.text_session.run(None, {"text": text_tokens.cpu().numpy()})
+            text_features = torch.from_numpy(outputs[0]).float()
+        elif self._text_in is not None and text_tokens.shape == self._text_in.shape:
+            # 非同期転送と推論が終わり CPU に戻すまでバッファを他のスレッドに触らせない
+            with self._text_lock, torch.no_grad():
+                self._text_host.copy_(text_tokens)
+                self._text_in.copy_(self._text_host, non_blocking=True)
+                text_features = self.model.encode_text(self._text_in).float().cpu()
+        else:
+            with torch.no_grad():
+                text_features = self.model.encode_text(text_tokens.to(self.device)).float()
+        return text_features / text_features.norm(dim=-1, keepdim=True)
+    
+    def encode_image(self, image_path: Union[str, Image.Image]) -> np.ndarray:
+        try:
+            image = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
+            image = image.convert('RGB')
+            image_input = self.preprocess(image).unsqueeze(0)
             
-            return image_features.cpu().numpy().flatten()
+            return self._encode_image_batch(image_input).cpu().numpy().astype(np.float32).reshape(-1)
         except Exception as e:
             print(f"Error encoding image {image_path}: {e}")
             return None
     
     def encode_text(self, text: str) -> np.ndarray:
         try:
-            text_tokens = clip.tokenize([text]).to(self.device)
-            
-            with torch.no_grad():
-                text_features = self.model.encode_text(text_tokens)
-                text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+            text_tokens = clip.tokenize([text])
             
-            return text_features.cpu().numpy().flatten()
+            return self._encode_text_tokens(text_tokens).cpu().numpy().astype(np.float32).reshape(-1)
         except Exception as e:
             print(f"Error encoding text '{text}': {e}")
             return None
     
+    def _get_indexed_mtimes(self, image_paths: List[str]) -> dict:
+        indexed_mtimes = {}
+        for start in range(0, len(image_paths), GET_BATCH_SIZE):
+            existing = self.collection.get(ids=image_paths[start:start + GET_BATCH_SIZE], include=['metadatas'])
+            for image_id, metadata in zip(existing['ids'], existing['metadatas']):
+                indexed_mtimes[image_id] = metadata.get('modified_time')
+        return indexed_mtimes
+    
+    @staticmethod
+    def _image_metadata(image_path: str, stat: os.stat_result) -> dict:
+        return {
+            "file_size": stat.st_size,
+            "modified_time": stat.st_mtime,
+            "file_name": os.path.basename(image_path)
+        }
+    
+    def _upsert(self, ids: List[str], embeddings: np.ndarray, metadatas: List[dict]):
+        # Chroma は numpy 配列をそのまま受け取れるので tolist() で Python の float に展開しない
+        if ids:
+            self.collection.upsert(ids=ids, embeddings=embeddings, metadatas=metadatas)
+    
     def add_image(self, image_path: str) -> bool:
         if not os.path.exists(image_path):
             return False
         
         try:
             stat = os.stat(image_path)
-            file_size = stat.st_size
-            modified_time = stat.st_mtime
             
-            existing = self.collection.get(ids=[image_path])
-            if existing['ids']:
-                existing_metadata = existing['metadatas'][0]
-                if existing_metadata.get('modified_time') == modified_time:
-                    return True
+            if self._get_indexed_mtimes([image_path]).get(image_path) == stat.st_mtime:
+                return True
             
             vector = self.encode_image(image_path)
             if vector is None:
                 return False
             
-            metadata = {
-                "file_size": file_size,
-                "modified_time": modified_time,
-                "file_name": os.path.basename(image_path)
-            }
-            
-            self.collection.upsert(
-                ids=[image_path],
-                embeddings=[vector.tolist()],
-                metadatas=[metadata]
-            )
+            self._upsert([image_path], vector[np.newaxis], [self._image_metadata(image_path, stat)])
             
             return True
         except Exception as e:
@@ -98,47 +396,81 @@ class CLIPVectorDB:
     
     def build_database(self, folder_path: str, image_extensions: List[str] = None, progress_callback=None):
         if image_extensions is None:
-            image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', '.heic']
+            extensions = IMAGE_EXTENSIONS
+        else:
+            extensions = frozenset(ext.lower() for ext in image_extensions)
         
-        image_files = []
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                if any(file.lower().endswith(ext) for ext in image_extensions):
-                    image_files.append(os.path.join(root, file))
+        image_files = list(_iter_image_files(folder_path, extensions))
         
         print(f"Found {len(image_files)} image files")
         total_files = len(image_files)
         
-        for i, image_path in enumerate(image_files):
-            self.add_image(image_path)
+        # 更新日時が変わっていない画像はまとめて除外する
+        indexed_mtimes = self._get_indexed_mtimes(image_files)
+        
+        with ThreadPoolExecutor(max_workers=STAT_WORKERS) as executor:
+            file_stats = list(executor.map(_stat_or_none, image_files))
+        
+        pending = [
+            (image_path, stat)
+            for image_path, stat in zip(image_files, file_stats)
+            if stat is not None and indexed_mtimes.get(image_path) != stat.st_mtime
+        ]
+        stats = dict(pending)
+        
+        processed = total_files - len(pending)
+        if progress_callback and processed:
+            progress_callback(processed / total_files, processed, total_files, "")
+        
+        buffer_ids, buffer_embeddings, buffer_metadatas = [], [], []
+        for batch_paths, batch, attempted in self._iter_image_batches([image_path for image_path, _ in pending]):
+            if batch_paths:
+                vectors = self._encode_image_batch(batch).cpu().numpy()
+                
+                buffer_ids.extend(batch_paths)
+                buffer_embeddings.append(vectors)
+                buffer_metadatas.extend(self._image_metadata(image_path, stats[image_path]) for image_path in batch_paths)
+                
+                if len(buffer_ids) >= UPSERT_BATCH_SIZE:
+                    self._upsert(buffer_ids, np.concatenate(buffer_embeddings), buffer_metadatas)
+                    buffer_ids, buffer_embeddings, buffer_metadatas = [], [], []
             
+            # 読み込みに失敗した画像も処理済みとして数える
+            processed += attempted
             if progress_callback:
-                progress = (i + 1) / total_files
-                progress_callback(progress, i + 1, total_files, os.path.basename(image_path))
+                progress = processed / total_files
+                progress_callback(progress, processed, total_files, os.path.basename(batch_paths[-1]) if batch_paths else "")
+        
+        if buffer_ids:
+            self._upsert(buffer_ids, np.concatenate(buffer_embeddings), buffer_metadatas)
     
-    def search_similar(self, query_image_path: str, top_k: int = 10) -> List[Tuple[str, float]]:
+    def search_similar(self, query_image_path: Union[str, Image.Image], top_k: int = 10) -> List[Tuple[str, float]]:
         query_vector = self.encode_image(query_image_path)
         if query_vector is None:
             return []
         
+        # メモリ上の画像はデータベースに登録されていないので除外の必要がない
+        exclude_id = query_image_path if isinstance(query_image_path, str) else None
+        return self.search_by_vector(query_vector, top_k, exclude_id=exclude_id)
+    
+    def search_by_vector(self, query_vector, top_k: int = 10, exclude_id: Optional[str] = None) -> List[Tuple[str, float]]:
         try:
+            # クエリ画像自身が登録されている可能性がある場合だけ 1 件多く取得する
+            n_results = top_k + 1 if exclude_id is not None else top_k
             results = self.collection.query(
-                query_embeddings=[query_vector.tolist()],
-                n_results=min(top_k + 1, self.collection.count()),
+                query_embeddings=[query_vector],
+                n_results=min(n_results, self.collection.count()),
                 include=['distances']
             )
             
-            similarities = []
-            for i, (file_path, cosine_distance) in enumerate(zip(results['ids'][0], results['distances'][0])):
-                if file_path == query_image_path:
-                    continue
-                
-                cosine_similarity = 1 - cosine_distance
-                similarities.append((file_path, float(cosine_similarity)))
-            
-            return similarities[:top_k]
+            similarities = (
+                (file_path, float(1 - cosine_distance))
+                for file_path, cosine_distance in zip(results['ids'][0], results['distances'][0])
+                if file_path != exclude_id
+            )
+            return list(itertools.islice(similarities, top_k))
         except Exception as e:
-            print(f"Error searching similar images: {e}")
+            print(f"Error searching by vector: {e}")
             return []
     
     def search_by_text(self, query_text: str, top_k: int = 10) -> List[Tuple[str, float]]:
@@ -146,22 +478,7 @@ class CLIPVectorDB:
         if query_vector is None:
             return []
         
-        try:
-            results = self.collection.query(
-                query_embeddings=[query_vector.tolist()],
-                n_results=min(top_k, self.collection.count()),
-                include=['distances']
-            )
-            
-            similarities = []
-            for i, (file_path, cosine_distance) in enumerate(zip(results['ids'][0], results['distances'][0])):
-                cosine_similarity = 1 - cosine_distance
-                similarities.append((file_path, float(cosine_similarity)))
-            
-            return similarities[:top_k]
-        except Exception as e:
-            print(f"Error searching by text '{query_text}': {e}")
-            return []
+        return self.search_by_vector(query_vector, top_k)
     
     def get_database_stats(self) -> dict:
         try:
@@ -171,11 +488,58 @@ class CLIPVectorDB:
             print(f"Error getting database stats: {e}")
             return {"total_images": 0}
     
+    def rebuild_index(self) -> bool:
+        """登録済みのベクトルを保持したまま、現在の HNSW 設定でコレクションを作り直します。"""
+        # HNSW のパラメータは作成時にしか設定できないため、別のコレクションに入れ直してから差し替える
+        self._delete_rebuild_collection()
+        try:
+            rebuilt = self.client.create_collection(
+                name=REBUILD_COLLECTION_NAME,
+                metadata=self._collection_metadata()
+            )
+            total = self.collection.count()
+            for offset in range(0, total, UPSERT_BATCH_SIZE):
+                batch = self.collection.get(
+                    limit=UPSERT_BATCH_SIZE,
+                    offset=offset,
+                    include=['embeddings', 'metadatas']
+                )
+                if batch['ids']:
+                    rebuilt.upsert(
+                        ids=batch['ids'],
+                        embeddings=np.asarray(batch['embeddings'], dtype=np.float32),
+                        metadatas=batch['metadatas']
+                    )
+        except Exception as e:
+            print(f"Error rebuilding index: {e}")
+            # 既存のコレクションには手を付けていないので、途中まで作ったものを捨てるだけでよい
+            self._delete_rebuild_collection()
+            return False
+        
+        try:
+            self.client.delete_collection(COLLECTION_NAME)
+            rebuilt.modify(name=COLLECTION_NAME)
+            self.collection = rebuilt
+            return True
+        except Exception as e:
+            # 入れ直し済みのコレクションは残しておき、次回の init_database で復元する
+            print(f"Error replacing index: {e}")
+            self.init_database()
+            return False
+    
+    def _delete_rebuild_collection(self):
+        try:
+            self.client.delete_collection(REBUILD_COLLECTION_NAME)
+        except Exception:
+            pass
+    
     def clear_database(self):
         """データベースをクリアし、新しい設定で再初期化します。"""
         try:
             # 既存のコレクションを削除
-            self.client.delete_collection("image_vectors")
+            self.client.delete_collection(COLLECTION_NAME)
+            # 中断した再構築の残りが復元されないように削除
+            self._delete_rebuild_collection()
             # 新しい設定でコレクションを再作成
             self.init_database()
             return True
@@ -2,6 +2,9 @@ import os
 import re
 from pathlib import Path
 
+# Windows のドライブ指定（C:\ や C:/）
+_WIN_DRIVE = re.compile(r'^[A-Za-z]:[\\\/]')
+
 def convert_windows_path_to_wsl(windows_path: str) -> str:
     r"""
     Windows形式のパスをWSL形式のパスに変換する
@@ -23,11 +26,12 @@ def convert_windows_path_to_wsl(windows_path: str) -> str:
         return windows_path
     
     # Windows形式のパス（C:\Users\...）を変換
-    if re.match(r'^[A-Za-z]:[\\\/]', windows_path):
+    match = _WIN_DRIVE.match(windows_path)
+    if match:
         # ドライブレター（C:）を取得
-        drive_letter = windows_path[0].lower()
+        drive_letter = match.group(0)[0].lower()
         # パスの残りの部分を取得
-        path_remainder = windows_path[3:]  # C:\ の部分を除く
+        path_remainder = windows_path[match.end():]  # C:\ の部分を除く
         
         # バックスラッシュをスラッシュに変換
         path_remainder = path_remainder.replace('\\', '/')
@@ -57,7 +61,7 @@ def convert_wsl_path_to_windows(wsl_path: str) -> str:
         return wsl_path
     
     # Windows形式のパスの場合はそのまま返す
-    if re.match(r'^[A-Za-z]:[\\\/]', wsl_path):
+    if _WIN_DRIVE.match(wsl_path):
         return wsl_path.replace('/', '\\')
     
     # WSL形式のパス（/mnt/c/...）を変換
@@ -0,0 +1,90 @@
+"""
+CLIP の画像/テキストエンコーダを ONNX にエクスポートする
+
+    uv run --no-sync --with onnx python scripts/export_clip.py --output-dir ./onnx
+
+出力された clip_image.onnx / clip_text.onnx は CLIPVectorDB が起動時に読み込み、
+onnxruntime-gpu (TensorRT / CUDA) で推論する。バッチ次元以外の形状は固定で、
+バッチ次元は TensorRT の最適化プロファイル (1〜ENCODE_BATCH_SIZE) で範囲を固定する。
+"""
+import argparse
+import os
+
+import clip
+import torch
+
+
+class _TextEncoder(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, text):
+        return self.model.encode_text(text)
+
+
+def _infer_shapes(onnx_path: str):
+    # TensorRT が静的なエンジンを構築できるようにシンボリックに形状を推論しておく
+    try:
+        import onnx
+        from onnxruntime.tools.symbolic_shape_infer import SymbolicShapeInference
+    except ImportError as e:
+        print(f"Skipping shape inference for {onnx_path}: {e}")
+        return
+
+    model = onnx.load(onnx_path)
+    model = SymbolicShapeInference.infer_shapes(model, auto_merge=True)
+    onnx.save(model, onnx_path)
+
+
+def export(model_name: str, output_dir: str, opset_version: int = 17):
+    os.makedirs(output_dir, exist_ok=True)
+
+    # FP32 でエクスポートし、精度の選択は実行側 (TensorRT の FP16 など) に任せる
+    model, _ = clip.load(model_name, device="cpu", jit=False)
+    model = model.float().eval()
+
+    input_resolution = model.visual.input_resolution
+    context_length = model.context_length
+
+    image_path = os.path.join(output_dir, "clip_image.onnx")
+    dummy_image = torch.zeros(1, 3, input_resolution, input_resolution)
+    torch.onnx.export(
+        model.visual,
+        dummy_image,
+        image_path,
+        input_names=["image"],
+        output_names=["features"],
+        dynamic_axes={"image": {0: "batch"}, "features": {0: "batch"}},
+        opset_version=opset_version
+    )
+    _infer_shapes(image_path)
+    print(f"Exported {image_path}")
+
+    text_path = os.path.join(output_dir, "clip_text.onnx")
+    dummy_text = clip.tokenize(["a photo"], context_length=context_length)
+    torch.onnx.export(
+        _TextEncoder(model),
+        dummy_text,
+        text_path,
+        input_names=["text"],
+        output_names=["features"],
+        dynamic_axes={"text": {0: "batch"}, "features": {0: "batch"}},
+        opset_version=opset_version
+    )
+    _infer_shapes(text_path)
+    print(f"Exported {text_path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export CLIP encoders to ONNX")
+    parser.add_argument("--model", default="ViT-B/32")
+    parser.add_argument("--output-dir", default="./onnx")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args()
+
+    export(args.model, args.output_dir, args.opset)
+
+
+if __name__ == "__main__":
+    main()